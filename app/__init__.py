@@ -4,6 +4,9 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_wtf.csrf import CSRFProtect
+from werkzeug.middleware.proxy_fix import ProxyFix
+from app.admission import AdmissionController
+from app.analytics import ViewCounter
 import os
 from dotenv import load_dotenv
 
@@ -14,6 +17,8 @@ load_dotenv()
 db = SQLAlchemy()
 login_manager = LoginManager()
 csrf = CSRFProtect()
+admission = AdmissionController()
+views = ViewCounter()
 
 def create_app():
     app = Flask(__name__)
@@ -23,6 +28,26 @@ def create_app():
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///blog.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     
+    # Canonical address used for links in feeds and sitemaps
+    app.config['SITE_URL'] = os.environ.get('SITE_URL') or (
+        f"{app.config['PREFERRED_URL_SCHEME']}://{app.config['SERVER_NAME']}" if app.config['SERVER_NAME']
+        else 'http://localhost:5001')
+    if not (os.environ.get('SITE_URL') or app.config['SERVER_NAME'] or app.debug):
+        app.logger.warning('SITE_URL is not set; RSS/Atom feeds and sitemaps will link to %s. '
+                           'Set SITE_URL to the public address of the site.', app.config['SITE_URL'])
+    
+    # Number of reverse proxies (e.g. nginx) in front of the app. Their
+    # X-Forwarded-For/-Proto headers are trusted so remote_addr is the real
+    # client, which per-client rate limits rely on. Leave at 0 without a proxy,
+    # or clients could spoof their address.
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'],
+                                x_proto=app.config['TRUSTED_PROXIES'])
+    
+    # Stream long post pages to the client as they render (opt-in)
+    app.config['STREAM_POST_PAGES'] = os.environ.get('STREAM_POST_PAGES', '').lower() in ('1', 'true', 'yes')
+    
     # CSRF Configuration
     app.config['WTF_CSRF_ENABLED'] = True
     app.config['WTF_CSRF_SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
@@ -31,6 +56,8 @@ def create_app():
     db.init_app(app)
     login_manager.init_app(app)
     csrf.init_app(app)
+    admission.init_app(app)
+    views.init_app(app)
     
     # Configure login manager
     login_manager.login_view = 'admin.login'
@@ -51,9 +78,19 @@ def create_app():
     app.register_blueprint(main_bp)
     app.register_blueprint(admin_bp, url_prefix='/admin')
     
+    # Preload hints for each page's critical assets
+    from app import preload
+    preload.init_app(app)
+    
+    # Register command line tools
+    from app.commands import register_commands
+    register_commands(app)
+    
     # Create database tables
     with app.app_context():
         db.create_all()
+        from app.models import add_missing_columns
+        add_missing_columns()
     
     return app
 
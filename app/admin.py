@@ -2,9 +2,14 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from app.models import Post, User, SiteConfig
+from app.models import Post, User, SiteConfig, SlugRedirect, DailyPostViews, DailyReferrers
 from app.forms import PostForm, LoginForm, UserForm
-from app import db, csrf
+from app import db, csrf, admission
+from app.feeds import rebuild_feeds
+from app.slugs import invalidate_slug_index
+from app.related import update_related
+from app.preview import render_preview
+from app.analytics import view_stats
 from datetime import datetime
 import os
 import uuid
@@ -38,6 +43,12 @@ def generate_unique_filename(filename):
     unique_name = f"{uuid.uuid4().hex[:12]}_{secure_filename(filename)}"
     return unique_name
 
+def published_content_changed(post_id):
+    """Regenerate precomputed public content after a write that affects a published post"""
+    rebuild_feeds()
+    invalidate_slug_index()
+    update_related(post_id)
+
 @admin_bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
@@ -69,6 +80,22 @@ def preview_post(id):
     post = Post.query.get_or_404(id)
     return render_template('post.html', post=post, is_preview=True)
 
+@admin_bp.route('/posts/preview-render', methods=['POST'])
+@login_required
+def preview_render():
+    """Render the editor content incrementally for the live preview pane"""
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get('content'), str):
+        return jsonify({'success': False, 'error': 'No content provided'}), 400
+
+    content_type = data.get('content_type', 'markdown')
+    known = data.get('known') or []
+    if not isinstance(known, list):
+        return jsonify({'success': False, 'error': '"known" must be a list'}), 400
+
+    patch = render_preview(data['content'], content_type, known)
+    return jsonify({'success': True, **patch})
+
 @admin_bp.route('/dashboard')
 @login_required
 def dashboard():
@@ -84,13 +111,23 @@ def dashboard():
     posts_per_page = SiteConfig.get_config('posts_per_page', '6')
     blog_posts_per_page = SiteConfig.get_config('blog_posts_per_page', '10')
     
+    # Page views from the daily rollups (buffered views are written every few seconds)
+    stats = view_stats()
+    
     return render_template('admin/dashboard.html', 
                          total_posts=total_posts,
                          published_posts=published_posts,
                          draft_posts=draft_posts,
                          recent_posts=recent_posts,
                          posts_per_page=posts_per_page,
-                         blog_posts_per_page=blog_posts_per_page)
+                         blog_posts_per_page=blog_posts_per_page,
+                         stats=stats)
+
+@admin_bp.route('/admission')
+@login_required
+def admission_metrics():
+    """Admitted, queued and shed request counts per endpoint group"""
+    return jsonify({'success': True, 'groups': admission.metrics()})
 
 @admin_bp.route('/posts')
 @login_required
@@ -112,6 +149,7 @@ def new_post():
 
         post = Post(
             title=form.title.data,
+            slug=Post.unique_slug(form.title.data),
             content=form.content.data,
             content_type=form.content_type.data,
             preview=form.preview.data,
@@ -125,6 +163,7 @@ def new_post():
         db.session.commit()
 
         if is_published:
+            published_content_changed(post.id)
             flash('Post published!', 'success')
         else:
             flash('Draft saved!', 'success')
@@ -142,6 +181,11 @@ def edit_post(id):
         # Determine publish status from button clicked
         action = request.form.get('action', 'draft')
         is_published = (action == 'publish')
+        was_published = post.published
+
+        # Renaming a post moves it to a new slug; the old one redirects
+        if form.title.data != post.title:
+            post.change_slug(Post.unique_slug(form.title.data, exclude_id=post.id))
 
         post.title = form.title.data
         post.content = form.content.data
@@ -156,6 +200,10 @@ def edit_post(id):
 
         db.session.commit()
 
+        # Drafts don't appear in public content, so only rebuild when published state is involved
+        if was_published or is_published:
+            published_content_changed(post.id)
+
         if is_published:
             flash('Post published!', 'success')
         else:
@@ -168,8 +216,14 @@ def edit_post(id):
 @login_required
 def delete_post(id):
     post = Post.query.get_or_404(id)
+    was_published = post.published
+    SlugRedirect.query.filter_by(post_id=post.id).delete()
+    DailyPostViews.query.filter_by(post_id=post.id).delete()
+    DailyReferrers.query.filter_by(post_id=post.id).delete()
     db.session.delete(post)
     db.session.commit()
+    if was_published:
+        published_content_changed(id)
     flash('Post deleted successfully!', 'success')
     return redirect(url_for('admin.posts'))
 
@@ -179,6 +233,7 @@ def toggle_publish(id):
     post = Post.query.get_or_404(id)
     post.published = not post.published
     db.session.commit()
+    published_content_changed(post.id)
 
     status = 'published' if post.published else 'unpublished'
 
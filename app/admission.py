@@ -0,0 +1,273 @@
+# Admission control and load shedding for expensive endpoints
+#
+# Each endpoint group gets a concurrency limit with a small bounded wait
+# queue, and optionally a token-bucket rate limit (globally or per client).
+# Requests beyond those limits are rejected immediately with 503/429 and a
+# Retry-After header instead of tying up a worker. State lives in a backend
+# that can be shared between gunicorn workers through a locked local file.
+
+from flask import current_app, request, g, jsonify, make_response
+from contextlib import contextmanager
+import fcntl
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+# Endpoint groups and their limits. rate is tokens per second, burst is the
+# bucket size. queue is how many requests may wait for a free slot, for at
+# most queue_timeout seconds. json groups answer rejections in the same
+# {'success': False, ...} shape as the admin AJAX endpoints.
+DEFAULT_GROUPS = {
+    'upload': {
+        'endpoints': ['admin.upload_image'],
+        'concurrency': 2, 'queue': 4, 'queue_timeout': 5.0,
+        'rate': 1.0, 'burst': 10,
+        'json': True,
+    },
+    'reorder': {
+        'endpoints': ['admin.reorder_posts'], 'methods': ['POST'],
+        'concurrency': 1, 'queue': 2, 'queue_timeout': 5.0,
+        'json': True,
+    },
+    'blog_pages': {
+        'endpoints': ['main.blog'],
+        'concurrency': 4, 'queue': 8, 'queue_timeout': 2.0,
+    },
+    'login': {
+        # check_password_hash is deliberately slow, so throttle per client
+        'endpoints': ['admin.login'], 'methods': ['POST'],
+        'concurrency': 2, 'queue': 4, 'queue_timeout': 3.0,
+        'rate': 0.1, 'burst': 5, 'per_client': True,
+    },
+}
+
+# How often a queued request re-checks for a free slot
+QUEUE_POLL_INTERVAL = 0.02
+
+METRIC_NAMES = ('admitted', 'queued', 'shed_concurrency', 'shed_rate')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _Backend:
+    """Limiter state operations; subclasses decide where the state lives"""
+
+    @contextmanager
+    def _transaction(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def _empty_state():
+        return {'inflight': {}, 'queued': {}, 'buckets': {}, 'metrics': {}}
+
+    @staticmethod
+    def _count(state, kind, group):
+        """Count slots held by live processes, dropping those of dead workers"""
+        holders = state[kind].setdefault(group, {})
+        for pid in [pid for pid in holders if not _pid_alive(int(pid))]:
+            del holders[pid]
+        return sum(holders.values())
+
+    @staticmethod
+    def _adjust(state, kind, group, delta):
+        holders = state[kind].setdefault(group, {})
+        pid = str(os.getpid())
+        holders[pid] = holders.get(pid, 0) + delta
+        if holders[pid] <= 0:
+            del holders[pid]
+
+    def try_acquire(self, group, limit):
+        with self._transaction() as state:
+            if self._count(state, 'inflight', group) >= limit:
+                return False
+            self._adjust(state, 'inflight', group, 1)
+            return True
+
+    def release(self, group):
+        with self._transaction() as state:
+            self._adjust(state, 'inflight', group, -1)
+
+    def join_queue(self, group, max_queue):
+        with self._transaction() as state:
+            if self._count(state, 'queued', group) >= max_queue:
+                return False
+            self._adjust(state, 'queued', group, 1)
+            return True
+
+    def leave_queue(self, group):
+        with self._transaction() as state:
+            self._adjust(state, 'queued', group, -1)
+
+    def take_token(self, key, rate, burst):
+        """Take one token from a bucket; returns seconds to wait, or 0 if allowed"""
+        now = time.time()
+        with self._transaction() as state:
+            tokens, updated = state['buckets'].get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens < 1:
+                state['buckets'][key] = (tokens, now)
+                return (1 - tokens) / rate
+            state['buckets'][key] = (tokens - 1, now)
+
+            # Forget buckets that have refilled completely
+            for stale in [k for k, (t, u) in state['buckets'].items() if t + (now - u) * rate >= burst]:
+                if stale != key:
+                    del state['buckets'][stale]
+            return 0
+
+    def incr(self, group, metric):
+        with self._transaction() as state:
+            metrics = state['metrics'].setdefault(group, dict.fromkeys(METRIC_NAMES, 0))
+            metrics[metric] += 1
+
+    def snapshot(self):
+        with self._transaction() as state:
+            return {
+                group: {
+                    **state['metrics'].get(group, dict.fromkeys(METRIC_NAMES, 0)),
+                    'inflight': self._count(state, 'inflight', group),
+                    'waiting': self._count(state, 'queued', group),
+                }
+                for group in set(state['metrics']) | set(state['inflight'])
+            }
+
+
+class MemoryBackend(_Backend):
+    """Limiter state for a single worker process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = self._empty_state()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            yield self._state
+
+
+class FileBackend(_Backend):
+    """Limiter state shared by all workers on the host through a locked JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # A damaged file only costs the current counts, never the site
+            return self._empty_state()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock, open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = self._read()
+                yield state
+                # Replace the file in one step so a killed worker can't leave it half written
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class AdmissionController:
+    """Flask extension that applies DEFAULT_GROUPS limits around requests"""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.groups = {}
+        self._endpoint_groups = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ADMISSION_ENABLED', True)
+        app.config.setdefault('ADMISSION_BACKEND', os.environ.get('ADMISSION_BACKEND', 'file'))
+        app.config.setdefault('ADMISSION_GROUPS', DEFAULT_GROUPS)
+
+        if app.config['ADMISSION_BACKEND'] == 'memory':
+            self.backend = MemoryBackend()
+        else:
+            os.makedirs(app.instance_path, exist_ok=True)
+            self.backend = FileBackend(os.path.join(app.instance_path, 'admission.json'))
+
+        self.groups = app.config['ADMISSION_GROUPS']
+        self._endpoint_groups = {
+            endpoint: name
+            for name, group in self.groups.items()
+            for endpoint in group['endpoints']
+        }
+
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def _reject(self, group, status, message, retry_after):
+        if group.get('json'):
+            response = make_response(jsonify({'success': False, 'message': message, 'error': message}), status)
+        else:
+            response = make_response(message, status)
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+
+    def _before_request(self):
+        if not current_app.config['ADMISSION_ENABLED']:
+            return None
+        name = self._endpoint_groups.get(request.endpoint)
+        if name is None:
+            return None
+        group = self.groups[name]
+        if 'methods' in group and request.method not in group['methods']:
+            return None
+
+        if group.get('rate'):
+            key = f'{name}:{request.remote_addr}' if group.get('per_client') else name
+            wait = self.backend.take_token(key, group['rate'], group['burst'])
+            if wait:
+                self.backend.incr(name, 'shed_rate')
+                return self._reject(group, 429, 'Too many requests, please slow down', wait)
+
+        if not self.backend.try_acquire(name, group['concurrency']):
+            if not self.backend.join_queue(name, group.get('queue', 0)):
+                self.backend.incr(name, 'shed_concurrency')
+                return self._reject(group, 503, 'Server busy, please retry shortly', group.get('queue_timeout', 1))
+
+            self.backend.incr(name, 'queued')
+            try:
+                deadline = time.monotonic() + group.get('queue_timeout', 1)
+                while not self.backend.try_acquire(name, group['concurrency']):
+                    if time.monotonic() >= deadline:
+                        self.backend.incr(name, 'shed_concurrency')
+                        return self._reject(group, 503, 'Server busy, please retry shortly', group.get('queue_timeout', 1))
+                    time.sleep(QUEUE_POLL_INTERVAL)
+            finally:
+                self.backend.leave_queue(name)
+
+        g.admission_group = name
+        self.backend.incr(name, 'admitted')
+        return None
+
+    def _teardown_request(self, exc):
+        name = g.pop('admission_group', None)
+        if name is not None:
+            self.backend.release(name)
+
+    def metrics(self):
+        """Per-group counts of admitted, queued and shed requests"""
+        return self.backend.snapshot()
@@ -0,0 +1,163 @@
+# Page-view analytics written in batches
+#
+# Recording a view only appends to an in-memory deque (atomic, no lock), so
+# it adds nothing measurable to a page view and never waits on a database
+# write lock. A background thread in each worker drains the deque every
+# ANALYTICS_FLUSH_INTERVAL seconds, or sooner once ANALYTICS_FLUSH_THRESHOLD
+# views are waiting, and adds the totals to the daily rollup tables in one
+# transaction. A crashed worker loses at most the views since its last flush.
+
+from flask import request
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+import atexit
+import os
+import re
+import threading
+
+from sqlalchemy import func, update
+
+# Crawlers and link previewers aren't readers
+_BOT_RE = re.compile(r'bot|crawl|spider|slurp|preview|fetch|curl|wget|python-requests', re.I)
+
+
+class ViewCounter:
+    """Flask extension that collects post views per worker and flushes them in batches"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._events = deque()
+        self._pending = Counter()  # Aggregated views whose write failed, retried next flush
+        self._wake = threading.Event()
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ANALYTICS_ENABLED', True)
+        app.config.setdefault('ANALYTICS_FLUSH_INTERVAL', int(os.environ.get('ANALYTICS_FLUSH_INTERVAL', 10)))
+        app.config.setdefault('ANALYTICS_FLUSH_THRESHOLD', 1000)
+        self.app = app
+        atexit.register(self.flush)
+
+    def record_view(self, post_id):
+        """Count a view of a post by the current request"""
+        if not self.app.config['ANALYTICS_ENABLED'] or request.method != 'GET':
+            return
+        if _BOT_RE.search(request.user_agent.string or ''):
+            return
+
+        referrer = ''
+        if request.referrer:
+            host = urlsplit(request.referrer).hostname or ''
+            if host != request.host.split(':')[0]:
+                referrer = host[:200]
+
+        # Threads don't survive a fork, so each gunicorn worker starts its own
+        if self._pid != os.getpid():
+            self._start()
+        self._events.append((datetime.utcnow().date(), post_id, referrer))
+        if len(self._events) >= self.app.config['ANALYTICS_FLUSH_THRESHOLD']:
+            self._wake.set()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Views copied from the parent process are the parent's to flush
+            self._events.clear()
+            self._pending.clear()
+            threading.Thread(target=self._run, name='analytics-flush', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.app.config['ANALYTICS_FLUSH_INTERVAL'])
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write waiting views to the rollup tables; returns the number of views written"""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        counts = self._pending
+        self._pending = Counter()
+        while True:
+            try:
+                counts[self._events.popleft()] += 1
+            except IndexError:
+                break
+        if not counts:
+            return 0
+
+        from app import db
+        from app.models import Post, DailyPostViews, DailyReferrers
+        with self.app.app_context():
+            try:
+                # Views of a post deleted since they were counted are dropped
+                post_ids = {post_id for _, post_id, _ in counts}
+                existing = {post_id for post_id, in db.session.query(Post.id).filter(Post.id.in_(post_ids))}
+                counts = Counter({key: views for key, views in counts.items() if key[1] in existing})
+                post_views = Counter()
+                for (day, post_id, _), views in counts.items():
+                    post_views[day, post_id] += views
+                _add_views(db, DailyPostViews, post_views, ('day', 'post_id'))
+                _add_views(db, DailyReferrers, counts, ('day', 'post_id', 'referrer'))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception('Could not flush %d page views, will retry', sum(counts.values()))
+                self._pending.update(counts)
+                return 0
+            finally:
+                db.session.remove()
+        return sum(counts.values())
+
+
+def _add_views(db, model, counts, key_columns):
+    """Add view counts to existing rollup rows, inserting rows that don't exist yet"""
+    new_rows = []
+    for key, views in counts.items():
+        conditions = [getattr(model, column) == value for column, value in zip(key_columns, key)]
+        result = db.session.execute(update(model).where(*conditions).values(views=model.views + views))
+        if result.rowcount == 0:
+            new_rows.append(dict(zip(key_columns, key), views=views))
+    if new_rows:
+        db.session.execute(model.__table__.insert(), new_rows)
+
+
+def view_stats(days=30, limit=10):
+    """Daily totals, top posts and top referrers over the last `days` days, from the rollups"""
+    from app import db
+    from app.models import Post, DailyPostViews, DailyReferrers
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+
+    daily = dict(db.session.query(DailyPostViews.day, func.sum(DailyPostViews.views))
+                 .join(Post, DailyPostViews.post_id == Post.id)
+                 .filter(DailyPostViews.day >= since)
+                 .group_by(DailyPostViews.day))
+    top_posts = (db.session.query(Post, func.sum(DailyPostViews.views).label('views'))
+                 .join(DailyPostViews, DailyPostViews.post_id == Post.id)
+                 .filter(DailyPostViews.day >= since)
+                 .group_by(Post.id)
+                 .order_by(func.sum(DailyPostViews.views).desc())
+                 .limit(limit)
+                 .all())
+    top_referrers = (db.session.query(DailyReferrers.referrer, func.sum(DailyReferrers.views))
+                     .join(Post, DailyReferrers.post_id == Post.id)
+                     .filter(DailyReferrers.day >= since)
+                     .group_by(DailyReferrers.referrer)
+                     .order_by(func.sum(DailyReferrers.views).desc())
+                     .limit(limit)
+                     .all())
+    return {
+        'days': [(since + timedelta(days=i), daily.get(since + timedelta(days=i), 0)) for i in range(days)],
+        'total': sum(daily.values()),
+        'top_posts': top_posts,
+        'top_referrers': top_referrers,
+    }
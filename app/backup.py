@@ -0,0 +1,283 @@
+# Online SQLite backups with incremental, page-level snapshots
+#
+# A snapshot is a gzip file plus a JSON manifest in the backup folder.
+# Full snapshots hold every database page; incremental snapshots hold only
+# the pages whose hash differs from the parent snapshot, so restoring one
+# replays the chain from the last full snapshot.
+
+from datetime import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import time
+
+# Pages copied per step of the online backup; the source is only locked
+# while a step runs, so writers get in between steps
+BACKUP_STEP_PAGES = 256
+
+# Seconds to sleep between backup steps to give writers a turn
+BACKUP_STEP_SLEEP = 0.005
+
+# Longest wait before retrying a backup that a write restarted; the wait
+# doubles with each restart up to this
+MAX_RESTART_BACKOFF = 2.0
+
+# Give up on a stepped backup that writers keep restarting after this many
+# seconds, rather than ever holding a lock that blocks them
+BACKUP_DEADLINE = 300
+
+# Start a new full snapshot once an incremental chain gets this long
+MAX_CHAIN_LENGTH = 30
+
+CHUNK_SIZE = 1024 * 1024
+
+_PAGE_HEADER = struct.Struct('>I')
+
+
+class BackupError(Exception):
+    pass
+
+
+class _BackupRestarted(Exception):
+    pass
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _page_hash(page):
+    return hashlib.sha1(page).hexdigest()[:16]
+
+
+def _manifest_path(backup_folder, snapshot_id):
+    return os.path.join(backup_folder, f'{snapshot_id}.json')
+
+
+def load_manifest(backup_folder, snapshot_id):
+    path = _manifest_path(backup_folder, snapshot_id)
+    if not os.path.exists(path):
+        raise BackupError(f'Snapshot {snapshot_id} not found in {backup_folder}')
+    with open(path) as f:
+        return json.load(f)
+
+
+def list_snapshots(backup_folder):
+    """Return all snapshot manifests, oldest first"""
+    if not os.path.exists(backup_folder):
+        return []
+    manifests = []
+    for filename in sorted(os.listdir(backup_folder)):
+        if filename.endswith('.json'):
+            manifests.append(load_manifest(backup_folder, filename[:-5]))
+    return manifests
+
+
+def _chain_length(backup_folder, manifest):
+    length = 1
+    while manifest['parent']:
+        manifest = load_manifest(backup_folder, manifest['parent'])
+        length += 1
+    return length
+
+
+def _online_copy(source_path, dest_path, progress=None):
+    """Copy a live database without blocking writers.
+
+    A WAL database is copied in one step: the copy reads a snapshot of the
+    database while writers keep appending to the WAL. Otherwise the copy uses
+    SQLite's online backup API a few pages at a time, since holding a read lock
+    for the whole copy would stall every writer. SQLite restarts a stepped
+    backup whenever another connection writes, so each restart waits longer
+    before retrying, and the backup fails after BACKUP_DEADLINE seconds.
+    """
+    deadline = time.monotonic() + BACKUP_DEADLINE
+    restarts = 0
+    last_remaining = None
+
+    def on_step(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if time.monotonic() > deadline:
+                raise _BackupRestarted()
+            time.sleep(min(BACKUP_STEP_SLEEP * 2 ** restarts, MAX_RESTART_BACKOFF))
+        last_remaining = remaining
+        if progress:
+            progress(status, remaining, total)
+
+    source = sqlite3.connect(source_path, timeout=30)
+    dest = sqlite3.connect(dest_path)
+    try:
+        journal_mode = source.execute('PRAGMA journal_mode').fetchone()[0]
+        if journal_mode.lower() == 'wal':
+            source.backup(dest, pages=-1, progress=progress)
+        else:
+            try:
+                source.backup(dest, pages=BACKUP_STEP_PAGES, progress=on_step, sleep=BACKUP_STEP_SLEEP)
+            except _BackupRestarted:
+                raise BackupError(
+                    f'Backup restarted {restarts} times in {BACKUP_DEADLINE}s because the database '
+                    'kept changing; retry when it is quieter, or switch it to WAL mode '
+                    '(PRAGMA journal_mode=WAL) so backups can run under constant writes') from None
+        page_size = dest.execute('PRAGMA page_size').fetchone()[0]
+    finally:
+        dest.close()
+        source.close()
+    return page_size
+
+
+def create_snapshot(source_path, backup_folder, full=False, progress=None):
+    """Take a consistent snapshot of a live database.
+
+    Writes an incremental snapshot against the latest one unless full is set,
+    there is no usable parent, or the chain has reached MAX_CHAIN_LENGTH.
+    Returns the new snapshot's manifest.
+    """
+    if not os.path.exists(source_path):
+        raise BackupError(f'Database {source_path} does not exist')
+    os.makedirs(backup_folder, exist_ok=True)
+
+    now = datetime.utcnow()
+    snapshot_id = now.strftime('%Y%m%d_%H%M%S_%f')
+
+    fd, copy_path = tempfile.mkstemp(suffix='.db', dir=backup_folder)
+    os.close(fd)
+    try:
+        page_size = _online_copy(source_path, copy_path, progress)
+
+        parent = None
+        if not full:
+            snapshots = list_snapshots(backup_folder)
+            if snapshots:
+                latest = snapshots[-1]
+                if latest['page_size'] == page_size and _chain_length(backup_folder, latest) < MAX_CHAIN_LENGTH:
+                    parent = latest
+
+        parent_hashes = parent['page_hashes'] if parent else []
+        page_hashes = []
+        changed_pages = 0
+        data_file = f'{snapshot_id}.pages.gz'
+        data_path = os.path.join(backup_folder, data_file)
+        db_digest = hashlib.sha256()
+
+        # Stream the copy page by page into the compressed snapshot,
+        # skipping pages that match the parent
+        with open(copy_path, 'rb') as src, gzip.open(data_path + '.tmp', 'wb') as out:
+            page_number = 0
+            for page in iter(lambda: src.read(page_size), b''):
+                db_digest.update(page)
+                page_hash = _page_hash(page)
+                page_hashes.append(page_hash)
+                if page_number >= len(parent_hashes) or parent_hashes[page_number] != page_hash:
+                    out.write(_PAGE_HEADER.pack(page_number))
+                    out.write(page)
+                    changed_pages += 1
+                page_number += 1
+        os.replace(data_path + '.tmp', data_path)
+    finally:
+        if os.path.exists(copy_path):
+            os.remove(copy_path)
+
+    manifest = {
+        'id': snapshot_id,
+        'type': 'incremental' if parent else 'full',
+        'parent': parent['id'] if parent else None,
+        'created_at': now.isoformat(),
+        'source': source_path,
+        'page_size': page_size,
+        'page_count': len(page_hashes),
+        'changed_pages': changed_pages,
+        'page_hashes': page_hashes,
+        'db_sha256': db_digest.hexdigest(),
+        'file': data_file,
+        'file_sha256': _sha256_file(data_path),
+    }
+    path = _manifest_path(backup_folder, snapshot_id)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+    return manifest
+
+
+def _snapshot_chain(backup_folder, snapshot_id):
+    """Return manifests from the base full snapshot up to snapshot_id"""
+    chain = []
+    manifest = load_manifest(backup_folder, snapshot_id)
+    while True:
+        chain.append(manifest)
+        if not manifest['parent']:
+            break
+        manifest = load_manifest(backup_folder, manifest['parent'])
+    chain.reverse()
+    return chain
+
+
+def _materialize(backup_folder, snapshot_id, target_path):
+    """Rebuild the database file for a snapshot by replaying its chain"""
+    chain = _snapshot_chain(backup_folder, snapshot_id)
+    with open(target_path, 'wb') as out:
+        for manifest in chain:
+            data_path = os.path.join(backup_folder, manifest['file'])
+            if _sha256_file(data_path) != manifest['file_sha256']:
+                raise BackupError(f'Checksum mismatch for {manifest["file"]}')
+
+            page_size = manifest['page_size']
+            with gzip.open(data_path, 'rb') as src:
+                while True:
+                    header = src.read(_PAGE_HEADER.size)
+                    if not header:
+                        break
+                    page_number, = _PAGE_HEADER.unpack(header)
+                    page = src.read(page_size)
+                    if len(page) != page_size:
+                        raise BackupError(f'Truncated page {page_number} in {manifest["file"]}')
+                    out.seek(page_number * page_size)
+                    out.write(page)
+        out.truncate(chain[-1]['page_count'] * chain[-1]['page_size'])
+    return chain[-1]
+
+
+def verify_snapshot(backup_folder, snapshot_id, target_path=None):
+    """Rebuild a snapshot and prove it matches its manifest and passes integrity_check.
+
+    If target_path is given the verified database is left there, otherwise
+    it is rebuilt into a temporary file and discarded.
+    """
+    fd, rebuilt_path = tempfile.mkstemp(suffix='.db', dir=backup_folder)
+    os.close(fd)
+    try:
+        manifest = _materialize(backup_folder, snapshot_id, rebuilt_path)
+        if _sha256_file(rebuilt_path) != manifest['db_sha256']:
+            raise BackupError(f'Rebuilt database for {snapshot_id} does not match its checksum')
+
+        conn = sqlite3.connect(f'file:{rebuilt_path}?mode=ro', uri=True)
+        try:
+            result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+        finally:
+            conn.close()
+        if result != 'ok':
+            raise BackupError(f'Integrity check failed for {snapshot_id}: {result}')
+
+        if target_path:
+            shutil.move(rebuilt_path, target_path)
+        return manifest
+    finally:
+        if os.path.exists(rebuilt_path):
+            os.remove(rebuilt_path)
+
+
+def restore_snapshot(backup_folder, snapshot_id, target_path, force=False):
+    """Verify a snapshot and write it out as a plain database file"""
+    if os.path.exists(target_path) and not force:
+        raise BackupError(f'{target_path} already exists')
+    return verify_snapshot(backup_folder, snapshot_id, target_path)
@@ -0,0 +1,133 @@
+# Command line tools, run with `flask --app run <command>`
+
+import click
+import os
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app import db
+from app.backup import create_snapshot, list_snapshots, verify_snapshot, restore_snapshot, BackupError
+from app.feeds import rebuild_feeds
+from app.models import Post
+from app.related import rebuild_related
+
+
+def get_backup_folder():
+    return os.path.join(current_app.instance_path, 'backups')
+
+
+def get_database_path():
+    """Get the path of the SQLite database file behind SQLALCHEMY_DATABASE_URI"""
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite' or not url.database or url.database == ':memory:':
+        raise click.ClickException('Backups are only supported for file-based SQLite databases')
+    return url.database
+
+
+@click.group()
+def backup():
+    """Online SQLite backups and point-in-time snapshots."""
+
+
+@backup.command('create')
+@click.option('--full', is_flag=True, help='Write a full snapshot instead of an incremental one.')
+@click.option('--folder', default=None, help='Backup folder (default: instance/backups).')
+@with_appcontext
+def backup_create(full, folder):
+    """Snapshot the live database without blocking writers."""
+    folder = folder or get_backup_folder()
+    try:
+        manifest = create_snapshot(get_database_path(), folder, full=full)
+    except BackupError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Created {manifest['type']} snapshot: {manifest['changed_pages']} of "
+               f"{manifest['page_count']} pages written", err=True)
+    click.echo(manifest['id'])
+
+
+@backup.command('list')
+@click.option('--folder', default=None, help='Backup folder (default: instance/backups).')
+@with_appcontext
+def backup_list(folder):
+    """List snapshots, oldest first."""
+    for manifest in list_snapshots(folder or get_backup_folder()):
+        click.echo(f"{manifest['id']}  {manifest['type']:<11}  "
+                   f"{manifest['changed_pages']}/{manifest['page_count']} pages  "
+                   f"parent={manifest['parent'] or '-'}")
+
+
+@backup.command('verify')
+@click.argument('snapshot_id')
+@click.option('--folder', default=None, help='Backup folder (default: instance/backups).')
+@with_appcontext
+def backup_verify(snapshot_id, folder):
+    """Rebuild a snapshot and check its checksums and integrity."""
+    try:
+        verify_snapshot(folder or get_backup_folder(), snapshot_id)
+    except BackupError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Snapshot {snapshot_id} is consistent')
+
+
+@backup.command('restore')
+@click.argument('snapshot_id')
+@click.argument('target')
+@click.option('--force', is_flag=True, help='Overwrite the target if it exists.')
+@click.option('--folder', default=None, help='Backup folder (default: instance/backups).')
+@with_appcontext
+def backup_restore(snapshot_id, target, force, folder):
+    """Verify a snapshot and write it to TARGET as a plain database file."""
+    try:
+        restore_snapshot(folder or get_backup_folder(), snapshot_id, target, force=force)
+    except BackupError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Restored snapshot {snapshot_id} to {target}')
+
+
+@click.group()
+def posts():
+    """Post maintenance."""
+
+
+@posts.command('backfill')
+@click.option('--batch-size', default=100, help='Posts to commit per transaction.')
+@with_appcontext
+def posts_backfill(batch_size):
+    """Re-render every post and fill in its derived metadata (TOC, word count, ...)."""
+    ids = [row.id for row in db.session.query(Post.id).order_by(Post.id)]
+    for start in range(0, len(ids), batch_size):
+        # Write with a plain UPDATE that keeps updated_at as is, since the posts
+        # weren't edited; the ORM's onupdate would otherwise bump it
+        with db.session.no_autoflush:
+            for post in Post.query.filter(Post.id.in_(ids[start:start + batch_size])):
+                content_html = post.convert_content()
+                db.session.execute(
+                    db.update(Post).where(Post.id == post.id).values(
+                        content_html=content_html,
+                        toc=post.toc,
+                        word_count=post.word_count,
+                        reading_time=post.reading_time,
+                        lead_image=post.lead_image,
+                        updated_at=Post.updated_at,
+                    )
+                )
+        db.session.expire_all()
+        db.session.commit()
+        click.echo(f'Backfilled {min(start + batch_size, len(ids))} of {len(ids)} posts', err=True)
+
+    # Headings gained anchors, so the feeds' content is stale
+    rebuild_feeds()
+    click.echo(f'Backfilled {len(ids)} posts')
+
+
+@posts.command('related')
+@with_appcontext
+def posts_related():
+    """Rebuild related-post suggestions for every published post."""
+    count = rebuild_related()
+    click.echo(f'Computed related posts for {count} posts')
+
+
+def register_commands(app):
+    app.cli.add_command(backup)
+    app.cli.add_command(posts)
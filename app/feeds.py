@@ -0,0 +1,267 @@
+# RSS/Atom feeds and sitemap.xml, precomputed from published posts
+
+from flask import current_app
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
+from email.utils import format_datetime
+from datetime import timezone
+from urllib.parse import urlsplit
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+
+from app.models import Post
+
+# Number of most recent posts included in the RSS/Atom feeds
+FEED_MAX_ENTRIES = 50
+
+# Sitemap protocol limit per file; past this sitemap.xml becomes an index
+SITEMAP_MAX_URLS = 50000
+
+# Public pages that always appear in the sitemap
+SITEMAP_STATIC_ENDPOINTS = ['main.home', 'main.blog', 'main.about', 'main.collaborate', 'main.contact', 'main.resume']
+
+MANIFEST_NAME = 'manifest.json'
+
+# In-memory copy of the on-disk artifacts, keyed by file name.
+# Each worker reloads from disk when the manifest changes.
+_cache = {'manifest_mtime': None, 'manifest': {}, 'bodies': {}}
+
+
+def get_feed_folder():
+    """Get the folder that holds the generated feeds, creating it if needed"""
+    feed_folder = os.path.join(current_app.instance_path, 'feeds')
+    if not os.path.exists(feed_folder):
+        os.makedirs(feed_folder)
+    return feed_folder
+
+
+@contextmanager
+def _locked(folder):
+    """Serialise rebuilds between workers and threads"""
+    with open(os.path.join(folder, 'rebuild.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _url_adapter():
+    """URL builder for the configured SITE_URL, so feeds never carry the host of whichever request rebuilt them"""
+    site = urlsplit(current_app.config['SITE_URL'])
+    return current_app.url_map.bind(site.netloc, script_name=site.path or '/', url_scheme=site.scheme)
+
+
+def _url(endpoint, **values):
+    return _url_adapter().build(endpoint, values, force_external=True)
+
+
+def _published_posts():
+    return Post.query.filter_by(published=True).order_by(Post.updated_at.desc())
+
+
+def _isoformat(dt):
+    return dt.replace(tzinfo=timezone.utc).isoformat()
+
+
+def _post_url(post):
+    return _url('main.post', slug=post.slug)
+
+
+class _ArtifactWriter:
+    """Write a file atomically while hashing its contents for the ETag"""
+
+    def __init__(self, folder, name):
+        self.path = os.path.join(folder, name)
+        fd, self.tmp_path = tempfile.mkstemp(dir=folder, prefix=f'.{name}.', suffix='.tmp')
+        self.digest = hashlib.sha1()
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.digest.update(data)
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        return self.digest.hexdigest()
+
+
+def _write_rss(folder, posts):
+    writer = _ArtifactWriter(folder, 'feed.xml')
+    writer.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    writer.write('<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom" '
+                 'xmlns:content="http://purl.org/rss/1.0/modules/content/">\n<channel>\n')
+    writer.write('<title>Christina Kneis Wolfenden</title>\n')
+    writer.write(f'<link>{escape(_url("main.home"))}</link>\n')
+    writer.write(f'<atom:link href="{escape(_url("main.rss_feed"))}" rel="self" type="application/rss+xml"/>\n')
+    writer.write('<description>Systems engineering, product development and operational excellence.</description>\n')
+    if posts:
+        writer.write(f'<lastBuildDate>{format_datetime(posts[0].updated_at.replace(tzinfo=timezone.utc))}</lastBuildDate>\n')
+    for post in posts:
+        link = escape(_post_url(post))
+        writer.write('<item>\n')
+        writer.write(f'<title>{escape(post.title)}</title>\n')
+        writer.write(f'<link>{link}</link>\n')
+        writer.write(f'<guid isPermaLink="true">{link}</guid>\n')
+        writer.write(f'<pubDate>{format_datetime(post.created_at.replace(tzinfo=timezone.utc))}</pubDate>\n')
+        writer.write(f'<description>{escape(post.preview)}</description>\n')
+        writer.write(f'<content:encoded><![CDATA[{post.content_html.replace("]]>", "]]]]><![CDATA[>")}]]></content:encoded>\n')
+        writer.write('</item>\n')
+    writer.write('</channel>\n</rss>\n')
+    return writer.close()
+
+
+def _write_atom(folder, posts):
+    writer = _ArtifactWriter(folder, 'atom.xml')
+    home = escape(_url('main.home'))
+    writer.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    writer.write('<feed xmlns="http://www.w3.org/2005/Atom">\n')
+    writer.write('<title>Christina Kneis Wolfenden</title>\n')
+    writer.write(f'<id>{home}</id>\n')
+    writer.write(f'<link href="{home}"/>\n')
+    writer.write(f'<link href="{escape(_url("main.atom_feed"))}" rel="self"/>\n')
+    writer.write('<author><name>Christina Kneis Wolfenden</name></author>\n')
+    if posts:
+        writer.write(f'<updated>{_isoformat(posts[0].updated_at)}</updated>\n')
+    for post in posts:
+        link = escape(_post_url(post))
+        writer.write('<entry>\n')
+        writer.write(f'<title>{escape(post.title)}</title>\n')
+        writer.write(f'<id>{link}</id>\n')
+        writer.write(f'<link href="{link}"/>\n')
+        writer.write(f'<published>{_isoformat(post.created_at)}</published>\n')
+        writer.write(f'<updated>{_isoformat(post.updated_at)}</updated>\n')
+        writer.write(f'<summary>{escape(post.preview)}</summary>\n')
+        writer.write(f'<content type="html">{escape(post.content_html)}</content>\n')
+        writer.write('</entry>\n')
+    writer.write('</feed>\n')
+    return writer.close()
+
+
+def _sitemap_urls():
+    """Yield (loc, lastmod) for every public URL without loading all posts at once"""
+    for endpoint in SITEMAP_STATIC_ENDPOINTS:
+        yield _url(endpoint), None
+    query = Post.query.with_entities(Post.slug, Post.updated_at).filter_by(published=True).order_by(Post.id)
+    for slug, updated_at in query.yield_per(1000):
+        yield _url('main.post', slug=slug), updated_at
+
+
+def _write_sitemaps(folder):
+    """Stream sitemap URLs to disk, sharding into an index past SITEMAP_MAX_URLS"""
+    etags = {}
+    shard = None
+    shard_count = 0
+    shard_urls = 0
+
+    def close_shard():
+        shard.write('</urlset>\n')
+        etags[f'sitemap-{shard_count}.xml'] = shard.close()
+
+    for loc, lastmod in _sitemap_urls():
+        if shard is None or shard_urls >= SITEMAP_MAX_URLS:
+            if shard is not None:
+                close_shard()
+            shard_count += 1
+            shard_urls = 0
+            shard = _ArtifactWriter(folder, f'sitemap-{shard_count}.xml')
+            shard.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            shard.write('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        shard.write(f'<url><loc>{escape(loc)}</loc>')
+        if lastmod:
+            shard.write(f'<lastmod>{_isoformat(lastmod)}</lastmod>')
+        shard.write('</url>\n')
+        shard_urls += 1
+    close_shard()
+
+    if shard_count == 1:
+        # Small site: the single shard is served directly as sitemap.xml
+        os.replace(os.path.join(folder, 'sitemap-1.xml'), os.path.join(folder, 'sitemap.xml'))
+        etags['sitemap.xml'] = etags.pop('sitemap-1.xml')
+        return etags
+
+    index = _ArtifactWriter(folder, 'sitemap.xml')
+    index.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    index.write('<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+    for n in range(1, shard_count + 1):
+        loc = _url('main.sitemap_shard', n=n)
+        index.write(f'<sitemap><loc>{escape(loc)}</loc></sitemap>\n')
+    index.write('</sitemapindex>\n')
+    etags['sitemap.xml'] = index.close()
+    return etags
+
+
+def _rebuild(folder):
+    posts = _published_posts().limit(FEED_MAX_ENTRIES).all()
+
+    manifest = {
+        'feed.xml': _write_rss(folder, posts),
+        'atom.xml': _write_atom(folder, posts),
+    }
+    manifest.update(_write_sitemaps(folder))
+
+    # Drop shards left over from a previously larger sitemap, and temp files
+    # from a rebuild that was killed part way
+    for filename in os.listdir(folder):
+        if (filename.startswith('sitemap-') and filename not in manifest) or filename.endswith('.tmp'):
+            os.remove(os.path.join(folder, filename))
+
+    writer = _ArtifactWriter(folder, MANIFEST_NAME)
+    writer.write(json.dumps(manifest))
+    writer.close()
+
+
+def rebuild_feeds():
+    """Regenerate every feed artifact from the published posts.
+
+    Call this after a write that changes published content. URLs are built
+    from SITE_URL, so this works outside a request (CLI commands) too.
+    """
+    folder = get_feed_folder()
+    with _locked(folder):
+        _rebuild(folder)
+
+
+def _load_manifest():
+    """Return the current manifest, reloading it if another worker rebuilt the feeds"""
+    manifest_path = os.path.join(get_feed_folder(), MANIFEST_NAME)
+    try:
+        mtime = os.stat(manifest_path).st_mtime_ns
+    except FileNotFoundError:
+        # First request after a deploy: one worker builds, the others wait for it
+        with _locked(get_feed_folder()):
+            if not os.path.exists(manifest_path):
+                _rebuild(get_feed_folder())
+            mtime = os.stat(manifest_path).st_mtime_ns
+
+    if mtime != _cache['manifest_mtime']:
+        with open(manifest_path) as f:
+            _cache['manifest'] = json.load(f)
+        _cache['bodies'] = {}
+        _cache['manifest_mtime'] = mtime
+    return _cache['manifest']
+
+
+def get_artifact_etag(name):
+    """Get the ETag for a generated file, or None if it does not exist"""
+    return _load_manifest().get(name)
+
+
+def get_artifact_path(name):
+    return os.path.join(get_feed_folder(), name)
+
+
+def get_artifact_body(name):
+    """Get a small generated file (RSS/Atom feed) from memory, loading it from disk once"""
+    _load_manifest()
+    body = _cache['bodies'].get(name)
+    if body is None:
+        with open(get_artifact_path(name), 'rb') as f:
+            body = f.read()
+        _cache['bodies'][name] = body
+    return body
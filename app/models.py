@@ -2,8 +2,114 @@ from app import db
 from flask_login import UserMixin
 from datetime import datetime
 from slugify import slugify
-from markdown import markdown
+from markdown import Markdown
 import bleach
+import html as html_lib
+import math
+import re
+import threading
+
+# For HTML posts, just sanitize the content
+HTML_ALLOWED_TAGS = [
+    'p', 'br', 'strong', 'em', 'u', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'ul', 'ol', 'li', 'blockquote', 'code', 'pre', 'a', 'img', 'hr',
+    'table', 'thead', 'tbody', 'tr', 'th', 'td', 'div', 'span', 'header',
+    'i', 'b', 'small', 'mark', 'del', 'ins', 'sub', 'sup'
+]
+HTML_ALLOWED_ATTRIBUTES = {
+    'a': ['href', 'title', 'target'],
+    'img': ['src', 'alt', 'title', 'width', 'height', 'style'],
+    'div': ['style', 'class'],
+    'span': ['style', 'class'],
+    'header': ['class'],
+    'h1': ['class'],
+    'p': ['class']
+}
+
+# For markdown posts, convert markdown to HTML then sanitize
+MARKDOWN_ALLOWED_TAGS = [
+    'p', 'br', 'strong', 'em', 'u', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'ul', 'ol', 'li', 'blockquote', 'code', 'pre', 'a', 'img', 'hr',
+    'table', 'thead', 'tbody', 'tr', 'th', 'td', 'div', 'span'
+]
+MARKDOWN_ALLOWED_ATTRIBUTES = {
+    'a': ['href', 'title', 'target'],
+    'img': ['src', 'alt', 'title', 'width', 'height', 'style'],
+    'div': ['style', 'class'],
+    'span': ['style', 'class']
+}
+
+# md_in_html allows markdown inside HTML blocks (like divs)
+MARKDOWN_EXTENSIONS = ['fenced_code', 'tables', 'codehilite', 'md_in_html']
+
+# Markdown instances are not thread-safe, so keep one per thread and reset between uses
+_markdown_local = threading.local()
+
+def _get_markdown():
+    md = getattr(_markdown_local, 'md', None)
+    if md is None:
+        md = Markdown(extensions=MARKDOWN_EXTENSIONS)
+        _markdown_local.md = md
+    return md.reset()
+
+def render_content(content, content_type='markdown'):
+    """Render post content to sanitized HTML"""
+    if content_type == 'html':
+        # Clean HTML content - don't escape HTML entities
+        return bleach.clean(
+            content,
+            tags=HTML_ALLOWED_TAGS,
+            attributes=HTML_ALLOWED_ATTRIBUTES,
+            strip=False,
+            strip_comments=False
+        )
+
+    html = _get_markdown().convert(content)
+    return bleach.clean(
+        html,
+        tags=MARKDOWN_ALLOWED_TAGS,
+        attributes=MARKDOWN_ALLOWED_ATTRIBUTES,
+        strip=False
+    )
+
+# Average adult silent reading speed, used for the reading time estimate
+WORDS_PER_MINUTE = 230
+
+_HEADING_RE = re.compile(r'<h([1-6])([^>]*)>(.*?)</h\1>', re.IGNORECASE | re.DOTALL)
+_ID_RE = re.compile(r'\bid=["\']([^"\']+)["\']')
+_TAG_RE = re.compile(r'<[^>]+>')
+_IMG_SRC_RE = re.compile(r'<img\b[^>]*?\bsrc=["\']([^"\']+)["\']', re.IGNORECASE)
+
+def html_to_text(html):
+    return html_lib.unescape(_TAG_RE.sub(' ', html))
+
+def add_heading_anchors(html, used=None):
+    """Give every heading a unique id; returns (html, table of contents entries).
+
+    used holds ids already taken earlier in the document and is updated in place.
+    """
+    toc = []
+    used = set() if used is None else used
+
+    def anchor(match):
+        level, attrs, inner = match.group(1), match.group(2), match.group(3)
+        text = ' '.join(html_to_text(inner).split())
+        existing = _ID_RE.search(attrs)
+        if existing:
+            anchor_id = existing.group(1)
+        else:
+            base = slugify(text) or 'section'
+            anchor_id = base
+            n = 2
+            while anchor_id in used:
+                anchor_id = f'{base}-{n}'
+                n += 1
+            attrs = f' id="{anchor_id}"{attrs}'
+        used.add(anchor_id)
+        toc.append({'level': int(level), 'id': anchor_id, 'text': text})
+        return f'<h{level}{attrs}>{inner}</h{level}>'
+
+    return _HEADING_RE.sub(anchor, html), toc
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -29,6 +135,12 @@ class Post(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # Derived from content_html at save time so page views only read them
+    toc = db.Column(db.JSON)  # [{'level': 2, 'id': 'anchor', 'text': 'Heading'}, ...]
+    word_count = db.Column(db.Integer)
+    reading_time = db.Column(db.Integer)  # Minutes
+    lead_image = db.Column(db.String(500))  # First image in the content, preloaded as the LCP image
+    
     def __init__(self, **kwargs):
         super(Post, self).__init__(**kwargs)
         if self.title and not self.slug:
@@ -37,60 +149,40 @@ class Post(db.Model):
             self.content_html = self.convert_content()
     
     def convert_content(self):
-        """Convert content to HTML based on content type"""
-        if self.content_type == 'html':
-            # For HTML posts, just sanitize the content
-            allowed_tags = [
-                'p', 'br', 'strong', 'em', 'u', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
-                'ul', 'ol', 'li', 'blockquote', 'code', 'pre', 'a', 'img', 'hr',
-                'table', 'thead', 'tbody', 'tr', 'th', 'td', 'div', 'span', 'header',
-                'i', 'b', 'small', 'mark', 'del', 'ins', 'sub', 'sup'
-            ]
-            allowed_attributes = {
-                'a': ['href', 'title', 'target'],
-                'img': ['src', 'alt', 'title', 'width', 'height', 'style'],
-                'div': ['style', 'class'],
-                'span': ['style', 'class'],
-                'header': ['class'],
-                'h1': ['class'],
-                'p': ['class']
-            }
-            
-            # Clean HTML content - don't escape HTML entities
-            clean_html = bleach.clean(
-                self.content, 
-                tags=allowed_tags, 
-                attributes=allowed_attributes,
-                strip=False,
-                strip_comments=False
-            )
-            return clean_html
-        else:
-            # For markdown posts, convert markdown to HTML
-            allowed_tags = [
-                'p', 'br', 'strong', 'em', 'u', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
-                'ul', 'ol', 'li', 'blockquote', 'code', 'pre', 'a', 'img', 'hr',
-                'table', 'thead', 'tbody', 'tr', 'th', 'td', 'div', 'span'
-            ]
-            allowed_attributes = {
-                'a': ['href', 'title', 'target'],
-                'img': ['src', 'alt', 'title', 'width', 'height', 'style'],
-                'div': ['style', 'class'],
-                'span': ['style', 'class']
-            }
-            
-            # Convert markdown to HTML
-            # md_in_html allows markdown inside HTML blocks (like divs)
-            html = markdown(self.content, extensions=['fenced_code', 'tables', 'codehilite', 'md_in_html'])
-            
-            # Clean the HTML
-            clean_html = bleach.clean(
-                html, 
-                tags=allowed_tags, 
-                attributes=allowed_attributes,
-                strip=False
-            )
-            return clean_html
+        """Convert content to HTML and recompute the metadata derived from it"""
+        html, self.toc = add_heading_anchors(render_content(self.content, self.content_type))
+        
+        words = len(html_to_text(html).split())
+        self.word_count = words
+        self.reading_time = max(1, math.ceil(words / WORDS_PER_MINUTE))
+        
+        image = _IMG_SRC_RE.search(html)
+        self.lead_image = html_lib.unescape(image.group(1)) if image else None
+        return html
+    
+    @classmethod
+    def unique_slug(cls, title, exclude_id=None):
+        """Slugify a title, adding a numeric suffix if another post already uses it"""
+        base = slugify(title)
+        slug = base
+        n = 2
+        while cls.query.filter(cls.slug == slug, cls.id != exclude_id).first():
+            slug = f'{base}-{n}'
+            n += 1
+        return slug
+    
+    def change_slug(self, new_slug):
+        """Move the post to a new slug, redirecting the old one to it"""
+        if new_slug == self.slug:
+            return
+        SlugRedirect.query.filter_by(old_slug=new_slug).delete()
+        if self.published:
+            redirect = SlugRedirect.query.filter_by(old_slug=self.slug).first()
+            if redirect:
+                redirect.post_id = self.id
+            else:
+                db.session.add(SlugRedirect(old_slug=self.slug, post_id=self.id))
+        self.slug = new_slug
     
     def update_content(self, content):
         """Update content and regenerate HTML"""
@@ -98,6 +190,33 @@ class Post(db.Model):
         self.content_html = self.convert_content()
         self.updated_at = datetime.utcnow()
 
+class SlugRedirect(db.Model):
+    """A slug a post used to have, kept so old links keep working"""
+    id = db.Column(db.Integer, primary_key=True)
+    old_slug = db.Column(db.String(200), unique=True, nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class RelatedPost(db.Model):
+    """Precomputed similar posts, best match first (see app/related.py)"""
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    related_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+class DailyPostViews(db.Model):
+    """Views per post per UTC day, written in batches by app/analytics.py"""
+    day = db.Column(db.Date, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    views = db.Column(db.Integer, nullable=False, default=0)
+
+class DailyReferrers(db.Model):
+    """Post views per referring site per UTC day; an empty referrer means a direct visit"""
+    day = db.Column(db.Date, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    referrer = db.Column(db.String(200), primary_key=True)
+    views = db.Column(db.Integer, nullable=False, default=0)
+
 class SiteConfig(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.String(100), unique=True, nullable=False)
@@ -123,3 +242,21 @@ class SiteConfig(db.Model):
             db.session.add(config)
         db.session.commit()
         return config
+
+def add_missing_columns():
+    """Add columns that exist on the models but not yet in the database.
+
+    db.create_all() only creates missing tables, so new nullable columns on
+    existing tables are added here with ALTER TABLE.
+    """
+    inspector = db.inspect(db.engine)
+    existing_tables = inspector.get_table_names()
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    conn.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
@@ -0,0 +1,113 @@
+# Preload Link headers and 103 Early Hints for each page's critical assets
+#
+# main.css pulls in its modules and Google Fonts through @import, so the
+# browser only discovers them after main.css has downloaded. Hero and post
+# images are only discovered once the HTML is parsed. Announcing them in a
+# Link header (and as 103 Early Hints where the server allows it) lets the
+# browser start fetching them right away.
+
+from flask import current_app, request, g, url_for
+import os
+import re
+
+STYLESHEET = 'css/main.css'
+
+# LCP image for pages whose hero is fixed in the template
+PAGE_IMAGES = {
+    'main.home': ['assets/home/me.png'],
+    'main.resume': ['assets/home/me.png'],
+}
+
+# HTML pages that get hints; other endpoints (feeds, redirects) are skipped
+PAGE_ENDPOINTS = {
+    'main.home', 'main.about', 'main.collaborate', 'main.contact',
+    'main.thankyou', 'main.resume', 'main.post', 'main.blog',
+}
+
+# Origins the fonts stylesheet loads from, matching the preconnects in base.html
+# (font files are fetched in CORS mode, the stylesheet is not)
+FONT_ORIGINS = [('https://fonts.googleapis.com', False), ('https://fonts.gstatic.com', True)]
+
+_IMPORT_RE = re.compile(r"""@import\s+url\(\s*['"]?([^'")]+)['"]?\s*\)""")
+
+# Rendered Link header per endpoint, built once per process
+_header_cache = {}
+
+
+def _stylesheet_imports(static_folder, filename):
+    """Return (local static paths, external URLs) imported by a stylesheet"""
+    local, external = [], []
+    with open(os.path.join(static_folder, filename)) as f:
+        css = f.read()
+    base = os.path.dirname(filename)
+    for target in _IMPORT_RE.findall(css):
+        if target.startswith(('http://', 'https://', '//')):
+            external.append(target)
+        else:
+            local.append(os.path.normpath(os.path.join(base, target)).replace(os.sep, '/'))
+    return local, external
+
+
+def _link(url, rel='preload', **params):
+    parts = [f'<{url}>', f'rel={rel}']
+    for key, value in params.items():
+        parts.append(key if value is True else f'{key}={value}')
+    return '; '.join(parts)
+
+
+def _static_links(endpoint):
+    """Links that are the same for every request to an endpoint"""
+    links = [_link(origin, rel='preconnect', crossorigin=True) if cors else _link(origin, rel='preconnect')
+             for origin, cors in FONT_ORIGINS]
+    links.append(_link(url_for('static', filename=STYLESHEET), **{'as': 'style'}))
+
+    local, external = _stylesheet_imports(current_app.static_folder, STYLESHEET)
+    links.extend(_link(url, **{'as': 'style'}) for url in external)
+    links.extend(_link(url_for('static', filename=path), **{'as': 'style'}) for path in local)
+
+    for image in PAGE_IMAGES.get(endpoint, []):
+        links.append(_link(url_for('static', filename=image), **{'as': 'image', 'fetchpriority': 'high'}))
+    return links
+
+
+def _get_static_links(endpoint):
+    links = _header_cache.get(endpoint)
+    if links is None:
+        links = _static_links(endpoint)
+        _header_cache[endpoint] = links
+    return links
+
+
+def preload_image(url):
+    """Mark an image the view knows is the page's LCP element"""
+    g.setdefault('preload_images', []).append(url)
+
+
+def preload_static_image(filename):
+    preload_image(url_for('static', filename=filename))
+
+
+def _send_early_hints():
+    # WSGI has no standard for informational responses; servers that support
+    # them expose a callable taking a list of (name, value) header pairs
+    early_hints = request.environ.get('wsgi.early_hints')
+    if request.method != 'GET' or request.endpoint not in PAGE_ENDPOINTS or not callable(early_hints):
+        return None
+    early_hints([('Link', link) for link in _get_static_links(request.endpoint)])
+    return None
+
+
+def _add_link_header(response):
+    if (request.endpoint not in PAGE_ENDPOINTS or response.status_code != 200
+            or response.mimetype != 'text/html'):
+        return response
+    links = list(_get_static_links(request.endpoint))
+    for url in g.get('preload_images', []):
+        links.append(_link(url, **{'as': 'image', 'fetchpriority': 'high'}))
+    response.headers.add('Link', ', '.join(links))
+    return response
+
+
+def init_app(app):
+    app.before_request(_send_early_hints)
+    app.after_request(_add_link_header)
@@ -0,0 +1,160 @@
+# Incremental live-preview rendering for the admin post editor
+
+from collections import OrderedDict
+import hashlib
+import re
+import threading
+
+from app.models import render_content, add_heading_anchors
+
+# Maximum number of rendered blocks kept in memory across all editors
+PREVIEW_CACHE_SIZE = 4096
+
+_FENCE_RE = re.compile(r'^\s{0,3}(`{3,}|~{3,})')
+_REFERENCE_RE = re.compile(r'^\s{0,3}\[[^\]]+\]:\s*\S')
+_LIST_ITEM_RE = re.compile(r'^\s{0,3}([*+-]|\d+[.)])\s')
+_QUOTE_RE = re.compile(r'^\s{0,3}>')
+_HTML_BLOCK_RE = re.compile(r'^<([a-zA-Z][a-zA-Z0-9-]*)(?=[\s/>])')
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _html_depth(line, tag):
+    """Net number of <tag> elements a line opens"""
+    opened = len(re.findall(rf'<{tag}(?=[\s/>])', line, re.I))
+    closed = len(re.findall(rf'</{tag}\s*>', line, re.I))
+    return opened - closed
+
+
+def split_blocks(content):
+    """Split markdown into top-level blocks separated by blank lines.
+
+    Anything that Markdown would read as one element across blank lines stays
+    in one block, so each block renders the same as in the full post:
+    fenced code, indented continuations (list paragraphs, indented code),
+    the items of a loose list, the paragraphs of a blockquote, raw HTML
+    blocks up to their closing tag and HTML comments up to their -->.
+    """
+    blocks = []
+    current = []
+    fence = None
+    html_tag = None
+    html_depth = 0
+    in_comment = False
+    in_list = False
+    in_quote = False
+    pending_blank = False
+
+    for line in content.replace('\r\n', '\n').split('\n'):
+        if fence:
+            current.append(line)
+            stripped = line.strip()
+            if stripped and set(stripped) == {fence[0]} and len(stripped) >= len(fence):
+                fence = None
+            continue
+
+        if in_comment:
+            current.append(line)
+            in_comment = '-->' not in line
+            continue
+
+        if html_tag:
+            current.append(line)
+            html_depth += _html_depth(line, html_tag)
+            if html_depth <= 0:
+                html_tag = None
+            continue
+
+        if not line.strip():
+            pending_blank = True
+            continue
+
+        continues = (line.startswith(('    ', '\t'))
+                     or (in_list and _LIST_ITEM_RE.match(line))
+                     or (in_quote and _QUOTE_RE.match(line)))
+        if pending_blank and current and not continues:
+            blocks.append('\n'.join(current))
+            current = []
+        elif pending_blank and current:
+            current.append('')
+        pending_blank = False
+
+        if not current:
+            in_list = bool(_LIST_ITEM_RE.match(line))
+            in_quote = bool(_QUOTE_RE.match(line))
+            in_comment = line.startswith('<!--') and '-->' not in line[4:]
+            match = _HTML_BLOCK_RE.match(line)
+            if match:
+                html_tag = match.group(1)
+                html_depth = _html_depth(line, html_tag)
+                if html_depth <= 0:
+                    html_tag = None
+
+        current.append(line)
+        match = _FENCE_RE.match(line)
+        if match:
+            fence = match.group(1)
+
+    if current:
+        blocks.append('\n'.join(current))
+    return blocks
+
+
+def block_hash(block, content_type):
+    return hashlib.sha1(f'{content_type}\0{block}'.encode('utf-8')).hexdigest()[:16]
+
+
+def render_block(block, content_type):
+    """Render one block, reusing the cached HTML when the block hasn't changed"""
+    key = block_hash(block, content_type)
+    with _cache_lock:
+        html = _cache.get(key)
+        if html is not None:
+            _cache.move_to_end(key)
+            return key, html
+
+    html = render_content(block, content_type)
+
+    with _cache_lock:
+        _cache[key] = html
+        if len(_cache) > PREVIEW_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return key, html
+
+
+def render_preview(content, content_type='markdown', known=()):
+    """Render content block by block and return a patch for the editor.
+
+    The patch lists the hashes of every block in document order, plus the
+    HTML for blocks the editor doesn't already have (those not in known).
+    HTML posts are sanitized as a single block since tags can span blank lines.
+    """
+    if content_type == 'html':
+        blocks = [content]
+    else:
+        blocks = split_blocks(content)
+        # Link reference definitions apply document-wide, so carry them into
+        # every block that might use one
+        references = [b for b in blocks if _REFERENCE_RE.match(b)]
+        if references:
+            suffix = '\n\n' + '\n'.join(references)
+            blocks = [b + suffix if '[' in b else b
+                      for b in blocks if not _REFERENCE_RE.match(b)]
+    known = set(known)
+
+    order = []
+    html = {}
+    used_ids = set()
+    for block in blocks:
+        key, block_html = render_block(block, content_type)
+        # Heading ids depend on earlier headings, so they're added after the
+        # cache, in document order, as convert_content does for the saved post
+        if '<h' in block_html:
+            block_html, _ = add_heading_anchors(block_html, used_ids)
+            key = block_hash(block_html, 'anchored')
+        order.append(key)
+        if key not in known:
+            html[key] = block_html
+
+    return {'blocks': order, 'html': html}
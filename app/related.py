@@ -0,0 +1,362 @@
+# Related posts from TF-IDF cosine similarity, computed at publish time
+#
+# The index in instance/related/index.npz holds the document frequency of
+# every term plus, for each published post, only its TERMS_PER_POST strongest
+# terms and its top-k neighbours, so it stays a few MB for tens of thousands
+# of posts. Each post's full set of distinct terms is kept in
+# instance/related/terms.db so that an edit can update the document
+# frequencies exactly by touching one row.
+#
+# A full build compares every published post against every other in blocks.
+# After that, publishing or editing one post only re-scores that post against
+# the corpus and recomputes neighbours for the posts whose top-k it enters or
+# leaves. Results are mirrored into the RelatedPost table for page views.
+# Untouched posts keep the terms and scores of their last computation;
+# `flask posts related` rebuilds everything with current weights.
+
+from flask import current_app
+from collections import Counter, defaultdict
+from contextlib import contextmanager, closing
+import fcntl
+import os
+import re
+import sqlite3
+
+import numpy as np
+from scipy import sparse
+
+from app import db
+from app.models import Post, RelatedPost
+
+# Neighbours stored per post
+RELATED_K = 5
+
+# Neighbours below this cosine similarity aren't worth showing
+MIN_SCORE = 0.05
+
+# Rows scored per matrix product in a full build; bounds memory to
+# BLOCK_SIZE x number of posts floats
+BLOCK_SIZE = 512
+
+# Only each post's strongest TF-IDF terms take part in similarity, which keeps
+# the post-by-post products sparse at little cost in match quality
+TERMS_PER_POST = 32
+
+# Title and preview terms say more about a post than body terms
+TITLE_WEIGHT = 3
+PREVIEW_WEIGHT = 2
+
+# Words of 3 to 31 characters; longer runs (data URIs, hashes, minified
+# code) are skipped whole rather than bloating the vocabulary
+_TOKEN_RE = re.compile(r'(?<![a-z0-9])[a-z][a-z0-9]{2,30}(?![a-z0-9])')
+_TAG_RE = re.compile(r'<[^>]+>')
+
+STOPWORDS = frozenset('''
+    about above after again against all also and any are because been before being below between both but can
+    could did does doing down during each few for from further had has have having her here hers him his how
+    into its just more most not now off once only other our ours out over own same she should some such than
+    that the their theirs them then there these they this those through too under until very was were what
+    when where which while who whom why will with would you your yours
+'''.split())
+
+
+def _tokens(text):
+    return _TOKEN_RE.findall(_TAG_RE.sub(' ', text or '').lower())
+
+
+def post_terms(post):
+    """Weighted bag of words for a post"""
+    counts = Counter(_tokens(post.content))
+    for text, weight in ((post.title, TITLE_WEIGHT), (post.preview, PREVIEW_WEIGHT)):
+        for token in _tokens(text):
+            counts[token] += weight
+    for stopword in STOPWORDS & counts.keys():
+        del counts[stopword]
+    return counts
+
+
+class _Index:
+    """Pruned term weights for the published corpus plus stored neighbours"""
+
+    def __init__(self, ids, rows, vocab, df, topk_ids, topk_scores):
+        self.ids = ids                  # post id per row
+        self.rows = rows                # CSR, rows x vocabulary, sublinear tf of each post's top terms
+        self.vocab = vocab              # list of terms, column order
+        # Looking up an unseen term gives it the next free column
+        self.columns = defaultdict(None, {term: i for i, term in enumerate(vocab)})
+        self.columns.default_factory = self.columns.__len__
+        self.df = df                    # number of posts containing each term
+        self.topk_ids = topk_ids        # rows x RELATED_K post ids, -1 for empty
+        self.topk_scores = topk_scores  # rows x RELATED_K similarities
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0, dtype=np.int64), sparse.csr_matrix((0, 0), dtype=np.float32), [],
+                   np.zeros(0, dtype=np.int64),
+                   np.full((0, RELATED_K), -1, dtype=np.int64), np.zeros((0, RELATED_K), dtype=np.float32))
+
+    def row_of(self, post_id):
+        rows = np.flatnonzero(self.ids == post_id)
+        return int(rows[0]) if len(rows) else None
+
+    def vectorize(self, term_dicts):
+        """Turn term-count dicts into a CSR count matrix, growing the vocabulary as needed"""
+        indices, data, indptr = [], [], [0]
+        for terms in term_dicts:
+            indices.extend(map(self.columns.__getitem__, terms))
+            data.extend(terms.values())
+            indptr.append(len(indices))
+        if len(self.columns) > len(self.vocab):
+            self.vocab = list(self.columns)
+            self.df = np.concatenate([self.df, np.zeros(len(self.vocab) - len(self.df), dtype=np.int64)])
+            self.rows.resize((self.rows.shape[0], len(self.vocab)))
+        return sparse.csr_matrix(
+            (np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr)),
+            shape=(len(term_dicts), len(self.vocab)))
+
+    def idf(self, n=None):
+        """Smoothed inverse document frequency for a corpus of n posts (default: the current rows)"""
+        n = len(self.ids) if n is None else n
+        return (np.log((1 + n) / (1 + self.df)) + 1).astype(np.float32)
+
+    def prune(self, counts, idf):
+        """Keep each row's TERMS_PER_POST strongest terms by TF-IDF, as sublinear tf"""
+        n = counts.shape[0]
+        tf = 1 + np.log(counts.data)
+        weights = tf * idf[counts.indices]
+
+        # Rank terms within each row: sort on row number minus a fraction (< 1)
+        # of the weight, so rows stay apart and heavier terms come first
+        rows = np.repeat(np.arange(n), np.diff(counts.indptr))
+        scale = 2 * weights.max() if len(weights) else 1
+        order = np.argsort(rows - weights / scale)
+        rank = np.arange(len(order)) - counts.indptr[rows[order]]
+        keep = np.sort(order[rank < TERMS_PER_POST])
+
+        return sparse.csr_matrix(
+            (tf[keep], counts.indices[keep],
+             np.concatenate([[0], np.cumsum(np.bincount(rows[keep], minlength=n))])),
+            shape=counts.shape)
+
+    def set_row(self, post_id, row):
+        """Add or replace one post's pruned row"""
+        keep = self.ids != post_id
+        self.rows = sparse.vstack([self.rows[np.flatnonzero(keep)], row], format='csr')
+        self.ids = np.append(self.ids[keep], post_id)
+        self.topk_ids = np.vstack([self.topk_ids[keep], np.full((1, RELATED_K), -1, dtype=np.int64)])
+        self.topk_scores = np.vstack([self.topk_scores[keep], np.zeros((1, RELATED_K), dtype=np.float32)])
+
+    def remove_row(self, post_id):
+        keep = self.ids != post_id
+        self.ids = self.ids[keep]
+        self.rows = self.rows[np.flatnonzero(keep)]
+        self.topk_ids = self.topk_ids[keep]
+        self.topk_scores = self.topk_scores[keep]
+
+    def weighted(self):
+        """TF-IDF weighted, L2-normalised rows"""
+        matrix = self.rows.copy()
+        matrix.data = matrix.data * self.idf()[matrix.indices]
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.diags(1 / norms).dot(matrix).tocsr().astype(np.float32)
+
+    def score_rows(self, matrix, rows):
+        """Recompute stored neighbours for the given rows against the whole corpus"""
+        transposed = matrix.T.tocsr()
+        for start in range(0, len(rows), BLOCK_SIZE):
+            block = rows[start:start + BLOCK_SIZE]
+            self.store_top(block, matrix[block].dot(transposed))
+
+    def store_top(self, rows, scores):
+        """Keep the RELATED_K best scoring posts for each row of a sparse score matrix"""
+        scores = scores.tocoo()
+        # Drop each post's match with itself and anything too weak to show
+        keep = (scores.col != rows[scores.row]) & (scores.data >= MIN_SCORE)
+        row, col, data = scores.row[keep], scores.col[keep], scores.data[keep]
+
+        # Cosine scores are at most 1, so halving them keeps rows apart
+        order = np.argsort(row - data / 2)
+        row, col, data = row[order], col[order], data[order]
+        starts = np.searchsorted(row, np.arange(len(rows)))
+        rank = np.arange(len(row)) - starts[row]
+        top = rank < RELATED_K
+
+        self.topk_ids[rows] = -1
+        self.topk_scores[rows] = 0
+        self.topk_ids[rows[row[top]], rank[top]] = self.ids[col[top]]
+        self.topk_scores[rows[row[top]], rank[top]] = data[top]
+
+
+def _index_folder():
+    folder = os.path.join(current_app.instance_path, 'related')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def _index_path():
+    return os.path.join(_index_folder(), 'index.npz')
+
+
+@contextmanager
+def _locked():
+    """Serialise index updates between workers"""
+    with open(os.path.join(_index_folder(), 'index.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _load():
+    path = _index_path()
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        if 'df' not in data:
+            return None  # Index from before df was stored; rebuild it
+        rows = sparse.csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+        text = data['vocab'].tobytes().decode('utf-8')
+        return _Index(data['ids'], rows, text.split('\n') if text else [], data['df'],
+                      data['topk_ids'], data['topk_scores'])
+
+
+def _encode_vocab(vocab):
+    """Store the vocabulary as one newline-joined UTF-8 string; a fixed-width
+    string array would pad every term to the longest one"""
+    return np.frombuffer('\n'.join(vocab).encode('utf-8'), dtype=np.uint8)
+
+
+def _save(index):
+    path = _index_path()
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, ids=index.ids, data=index.rows.data, indices=index.rows.indices,
+                 indptr=index.rows.indptr, shape=np.array(index.rows.shape), df=index.df,
+                 vocab=_encode_vocab(index.vocab), topk_ids=index.topk_ids, topk_scores=index.topk_scores)
+    os.replace(path + '.tmp', path)
+
+
+def _terms_db():
+    """Each post's distinct term columns, for exact document-frequency updates"""
+    conn = sqlite3.connect(os.path.join(_index_folder(), 'terms.db'))
+    conn.execute('CREATE TABLE IF NOT EXISTS post_terms (post_id INTEGER PRIMARY KEY, columns BLOB NOT NULL)')
+    return closing(conn)
+
+
+def _stored_columns(conn, post_id):
+    row = conn.execute('SELECT columns FROM post_terms WHERE post_id = ?', (post_id,)).fetchone()
+    return np.frombuffer(row[0], dtype=np.int32) if row else np.zeros(0, dtype=np.int32)
+
+
+def _write_rows(index, rows):
+    """Mirror the stored neighbours of the given rows into the RelatedPost table"""
+    post_ids = [int(index.ids[row]) for row in rows]
+    for start in range(0, len(post_ids), 500):
+        RelatedPost.query.filter(RelatedPost.post_id.in_(post_ids[start:start + 500])).delete(synchronize_session=False)
+    values = [
+        {'post_id': int(index.ids[row]), 'rank': rank, 'related_id': int(related_id), 'score': float(score)}
+        for row in rows
+        for rank, (related_id, score) in enumerate(zip(index.topk_ids[row], index.topk_scores[row]))
+        if related_id >= 0
+    ]
+    if values:
+        db.session.execute(RelatedPost.__table__.insert(), values)
+
+
+def _rebuild():
+    index = _Index.empty()
+    # Plain rows rather than Post objects; post_terms only reads these columns
+    posts = (db.session.query(Post.id, Post.title, Post.preview, Post.content)
+             .filter(Post.published.is_(True)).order_by(Post.id))
+    ids, terms = [], []
+    for post in posts.yield_per(500):
+        ids.append(post.id)
+        terms.append(post_terms(post))
+
+    counts = index.vectorize(terms)
+    index.df = np.bincount(counts.indices, minlength=counts.shape[1]).astype(np.int64)
+    index.ids = np.array(ids, dtype=np.int64)
+    index.rows = index.prune(counts, index.idf())
+    index.topk_ids = np.full((len(ids), RELATED_K), -1, dtype=np.int64)
+    index.topk_scores = np.zeros((len(ids), RELATED_K), dtype=np.float32)
+
+    rows = np.arange(len(ids))
+    index.score_rows(index.weighted(), rows)
+
+    RelatedPost.query.delete(synchronize_session=False)
+    _write_rows(index, rows)
+    db.session.commit()
+    _save(index)
+
+    with _terms_db() as conn, conn:
+        conn.execute('DELETE FROM post_terms')
+        conn.executemany('INSERT INTO post_terms (post_id, columns) VALUES (?, ?)', (
+            (post_id, counts.indices[counts.indptr[i]:counts.indptr[i + 1]].astype(np.int32).tobytes())
+            for i, post_id in enumerate(ids)))
+    return len(ids)
+
+
+def rebuild_related():
+    """Build the index and every post's neighbours from scratch"""
+    with _locked():
+        return _rebuild()
+
+
+def update_related(post_id):
+    """Update neighbours after one post was published, edited, unpublished or deleted"""
+    with _locked():
+        index = _load()
+        if index is None:
+            _rebuild()
+            return
+
+        post = Post.query.get(post_id)
+        with _terms_db() as conn, conn:
+            # Take the post's old terms out of the document frequencies
+            np.subtract.at(index.df, _stored_columns(conn, post_id), 1)
+
+            if post is None or not post.published:
+                conn.execute('DELETE FROM post_terms WHERE post_id = ?', (post_id,))
+                index.remove_row(post_id)
+                RelatedPost.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+                affected = np.flatnonzero((index.topk_ids == post_id).any(axis=1))
+                matrix = index.weighted() if len(affected) else None
+            else:
+                counts = index.vectorize([post_terms(post)])
+                np.add.at(index.df, counts.indices, 1)
+                conn.execute('INSERT OR REPLACE INTO post_terms (post_id, columns) VALUES (?, ?)',
+                             (post_id, counts.indices.astype(np.int32).tobytes()))
+
+                known = index.row_of(post_id) is not None
+                index.set_row(post_id, index.prune(counts, index.idf(len(index.ids) + (0 if known else 1))))
+                row = index.row_of(post_id)
+                matrix = index.weighted()
+
+                scores = matrix[row].dot(matrix.T)
+                index.store_top(np.array([row]), scores)
+                scores = scores.toarray().ravel()
+
+                # Other posts whose top-k the edited post enters, or is already in
+                # (its score may have dropped), get their neighbours recomputed
+                kth = np.where(index.topk_ids[:, -1] >= 0, index.topk_scores[:, -1], MIN_SCORE)
+                contains = (index.topk_ids == post_id).any(axis=1)
+                others = np.flatnonzero((contains | (scores >= kth)) & (np.arange(len(scores)) != row))
+                affected = np.append(others, row)
+
+            others = affected[index.ids[affected] != post_id]
+            if len(others):
+                index.score_rows(matrix, others)
+            if len(affected):
+                _write_rows(index, affected)
+            db.session.commit()
+            _save(index)
+
+
+def get_related(post, limit=3):
+    """Published related posts for a post, best match first"""
+    return (Post.query.join(RelatedPost, RelatedPost.related_id == Post.id)
+            .filter(RelatedPost.post_id == post.id, Post.published.is_(True))
+            .order_by(RelatedPost.rank)
+            .limit(limit)
+            .all())
@@ -1,8 +1,12 @@
 # Define the routes for the web app
 
-from flask import Blueprint, render_template, request, redirect, url_for, abort
+from flask import Blueprint, render_template, request, redirect, url_for, abort, send_file, Response, current_app
 from app.models import Post, SiteConfig
-from app import db
+from app import db, views
+from app import feeds, slugs
+from app.preload import preload_image, preload_static_image
+from app.streaming import stream_page
+from app.related import get_related
 
 main_bp = Blueprint('main', __name__)
 
@@ -43,11 +47,24 @@ def resume():
 
 @main_bp.route("/posts/<slug>")
 def post(slug):
+    # Unknown slugs are answered from the in-memory index without a query
+    current_slug = slugs.lookup(slug)
+    if current_slug is None:
+        abort(404)
+    if current_slug != slug:
+        return redirect(url_for('main.post', slug=current_slug), code=301)
+    
     # Find post by slug
     post = Post.query.filter_by(slug=slug, published=True).first()
     
     if post:
-        return render_template('post.html', post=post)
+        if post.lead_image:
+            preload_image(post.lead_image)
+        views.record_view(post.id)
+        related_posts = get_related(post)
+        if current_app.config['STREAM_POST_PAGES']:
+            return stream_page('post.html', post=post, related_posts=related_posts)
+        return render_template('post.html', post=post, related_posts=related_posts)
     else:
         abort(404)
 
@@ -61,4 +78,42 @@ def blog():
         page=page, per_page=per_page, error_out=False
     )
     
-    return render_template('blog.html', posts=posts)
+    # The first card image is above the fold: preload it and load it eagerly
+    lcp_post = next((post for post in posts.items if post.image), None)
+    if lcp_post:
+        preload_static_image(lcp_post.image)
+    
+    return render_template('blog.html', posts=posts, lcp_post=lcp_post)
+
+def _feed_response(name, mimetype):
+    """Serve a precomputed feed file with an ETag so unchanged feeds return 304"""
+    etag = feeds.get_artifact_etag(name)
+    if etag is None:
+        abort(404)
+
+    if name.startswith('sitemap'):
+        # Sitemaps can be large, so stream them from disk
+        response = send_file(feeds.get_artifact_path(name), mimetype=mimetype, etag=etag, conditional=True)
+    else:
+        response = Response(feeds.get_artifact_body(name), mimetype=mimetype)
+        response.set_etag(etag)
+        response = response.make_conditional(request)
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response
+
+@main_bp.route("/feed.xml")
+def rss_feed():
+    return _feed_response('feed.xml', 'application/rss+xml')
+
+@main_bp.route("/atom.xml")
+def atom_feed():
+    return _feed_response('atom.xml', 'application/atom+xml')
+
+@main_bp.route("/sitemap.xml")
+def sitemap():
+    return _feed_response('sitemap.xml', 'application/xml')
+
+@main_bp.route("/sitemap-<int:n>.xml")
+def sitemap_shard(n):
+    return _feed_response(f'sitemap-{n}.xml', 'application/xml')
@@ -0,0 +1,62 @@
+# In-memory index of published post slugs and old-slug redirects
+#
+# Lets main.post answer unknown slugs (mostly bots and scanners) with a 404
+# without a database query, and 301 renamed posts from their old slug.
+# Admin writes touch a stamp file; each worker rebuilds its index when the
+# stamp's mtime changes.
+
+from flask import current_app
+import os
+import threading
+
+from app import db
+from app.models import Post, SlugRedirect
+
+STAMP_NAME = 'slug_index.stamp'
+
+_lock = threading.Lock()
+_index = {'stamp': None, 'slugs': {}}
+
+
+def _stamp_path():
+    return os.path.join(current_app.instance_path, STAMP_NAME)
+
+
+def _stamp_mtime():
+    try:
+        return os.stat(_stamp_path()).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def _build():
+    """Map every published slug to itself and every old slug to its post's current slug"""
+    slugs = {slug: slug for slug, in db.session.query(Post.slug).filter_by(published=True)}
+    redirects = (db.session.query(SlugRedirect.old_slug, Post.slug)
+                 .join(Post, SlugRedirect.post_id == Post.id)
+                 .filter(Post.published.is_(True)))
+    for old_slug, slug in redirects:
+        # A live post using the slug again takes precedence over the redirect
+        slugs.setdefault(old_slug, slug)
+    return slugs
+
+
+def lookup(slug):
+    """Return the current slug for a published post, or None if there is no such post"""
+    stamp = _stamp_mtime()
+    if stamp != _index['stamp']:
+        with _lock:
+            if stamp != _index['stamp']:
+                _index['slugs'] = _build()
+                _index['stamp'] = stamp
+    return _index['slugs'].get(slug)
+
+
+def invalidate_slug_index():
+    """Tell every worker to rebuild its index; call after slug or publish changes"""
+    os.makedirs(current_app.instance_path, exist_ok=True)
+    with open(_stamp_path(), 'a'):
+        pass
+    os.utime(_stamp_path())
+    # Force this worker to rebuild even if the mtime didn't visibly change
+    _index['stamp'] = None
@@ -0,0 +1,42 @@
+# Streamed page rendering for long posts
+
+from flask import Response, stream_template
+
+# Target size of each chunk written to the client
+STREAM_CHUNK_SIZE = 8 * 1024
+
+
+def _buffered(pieces, chunk_size):
+    """Regroup Jinja's many small template pieces into chunks of about chunk_size.
+
+    The document head is flushed as soon as it has been rendered, so the
+    browser can start fetching CSS and fonts while the rest is generated.
+    Large pieces (the post body) are sent in chunk_size slices.
+    """
+    buffer = []
+    size = 0
+    head_sent = False
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if not head_sent and '</head>' in piece:
+            head_sent = True
+        elif size < chunk_size:
+            continue
+
+        data = ''.join(buffer)
+        buffer = []
+        size = 0
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+    if buffer:
+        yield ''.join(buffer)
+
+
+def stream_page(template_name, **context):
+    """Render a template as a streamed response instead of one string"""
+    response = Response(_buffered(stream_template(template_name, **context), STREAM_CHUNK_SIZE),
+                        mimetype='text/html')
+    # Let nginx pass chunks through instead of collecting the whole page
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Benchmark streamed vs. buffered rendering of a long post page.
+Reports time to first byte, total time and peak Python memory for each mode,
+using a throwaway SQLite database so your real data is untouched.
+"""
+
+import sys
+import os
+import tempfile
+import time
+import tracemalloc
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# Point the app at a temporary database before it is imported
+_tmpdir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}"
+
+from werkzeug.test import EnvironBuilder
+from app import create_app, db
+from app.models import Post
+
+SECTIONS = 400
+RUNS = 5
+
+
+def build_long_post():
+    """Roughly 30k words of markdown with headings, lists and code blocks"""
+    paragraph = ' '.join(['Systems engineering connects intent to implementation.'] * 12)
+    parts = []
+    for i in range(SECTIONS):
+        parts.append(f"## Section {i}\n\n{paragraph}\n\n- one\n- two\n- three\n\n"
+                     f"```python\ndef step_{i}(x):\n    return x * {i}\n```")
+    return '\n\n'.join(parts)
+
+
+def measure(app, path):
+    """Return (ttfb, total, peak bytes, body bytes) for one request through the WSGI app"""
+    environ = EnvironBuilder(path=path).get_environ()
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    body = app.wsgi_app(environ, start_response)
+    ttfb = None
+    size = 0
+    try:
+        for chunk in body:
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+            size += len(chunk)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    total = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return ttfb, total, peak, size
+
+
+def run_benchmark():
+    app = create_app()
+    app.config['ADMISSION_ENABLED'] = False
+
+    with app.app_context():
+        post = Post(title='Benchmark Post', content=build_long_post(), preview='Benchmark', published=True)
+        db.session.add(post)
+        db.session.commit()
+        path = f'/posts/{post.slug}'
+
+    for mode, streaming in (('buffered', False), ('streamed', True)):
+        app.config['STREAM_POST_PAGES'] = streaming
+        measure(app, path)  # Warm up template and slug caches
+        results = [measure(app, path) for _ in range(RUNS)]
+        ttfb = min(r[0] for r in results) * 1000
+        total = min(r[1] for r in results) * 1000
+        peak = max(r[2] for r in results) / 1024
+        print(f"{mode:>9}: TTFB {ttfb:7.2f} ms | total {total:7.2f} ms | "
+              f"peak memory {peak:8.1f} KiB | body {results[0][3] / 1024:.0f} KiB")
+
+
+if __name__ == '__main__':
+    run_benchmark()